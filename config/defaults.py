@@ -182,6 +182,13 @@ _C.TEST.VIDEOS_PER_BATCH = 16
 _C.TEST.EXTEND_SCALE = (0.1, 0.05)
 _C.TEST.BOX_THRESH = 0.8
 _C.TEST.ACTION_THRESH = 0.05
+# Data type used by autocast in inference, can be 'float16' or 'bfloat16'.
+# Leave it empty to run in float32.
+_C.TEST.AMP_DTYPE = ""
+# Compile the backbone with torch.compile in the demo, when PyTorch and Triton support it.
+_C.TEST.COMPILE = True
+# Pool person and object features with a single roi pooling call per pathway.
+_C.TEST.FUSE_ROI = False
 
 # ---------------------------------------------------------------------------- #
 # Misc options
@@ -32,14 +32,16 @@ class TemporalCrop(object):
         self.sample_rate = sample_rate
         self.temporal_jitter = temporal_jitter
 
-    def __call__(self, clip, target, transform_randoms):
-        # crop the input frames from raw clip
-        raw_frame_num = clip.shape[0]
-
+    def get_indices(self, raw_frame_num):
         # determine frame start based on frame_num, sample_rate and the jitter shift.
         frame_start = (raw_frame_num - self.frame_num * self.sample_rate) // 2 + (self.sample_rate - 1) // 2 + self.temporal_jitter
         idx = np.arange(frame_start, frame_start + self.frame_num * self.sample_rate, self.sample_rate)
         idx = np.clip(idx, 0, raw_frame_num - 1)
+        return idx
+
+    def __call__(self, clip, target, transform_randoms):
+        # crop the input frames from raw clip
+        idx = self.get_indices(clip.shape[0])
 
         clip = clip[idx]
         return clip, target, transform_randoms
@@ -124,7 +126,11 @@ class Normalize(object):
 
     def __call__(self, clip, target, transform_randoms):
         if self.to_bgr:
-            clip = clip[[2, 1, 0]]
+            # Swap the channels while subtracting the mean, instead of copying the whole clip first.
+            normalized = torch.empty_like(clip)
+            for t, c, m, s in zip(normalized, (2, 1, 0), self.mean, self.std):
+                torch.sub(clip[c], m, out=t).div_(s)
+            return normalized, target, transform_randoms
         # normalize: (x-mean)/std
         clip = self.video_normalize(clip, self.mean, self.std)
         return clip, target, transform_randoms
@@ -137,6 +143,17 @@ class SlowFastCrop(object):
         self.alpha = alpha
         self.slow_jitter = slow_jitter
 
+    def get_indices(self, frame_num):
+        # indices of the frames kept in slow pathway and fast pathway, without jitter.
+        slow_start = (self.tau - 1) // 2
+        slow_idx = np.arange(slow_start, frame_num, self.tau)
+
+        fast_stride = self.tau // self.alpha
+        fast_start = (fast_stride - 1) // 2
+        fast_idx = np.arange(fast_start, frame_num, fast_stride)
+
+        return slow_idx, fast_idx
+
     def __call__(self, clip, target, transform_randoms):
         if self.slow_jitter:
             # if jitter, random choose a start
@@ -1,17 +1,23 @@
+import contextlib
 import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
+from threading import Thread
 from structures.bounding_box import BoxList
 import numpy as np
 import queue
 from tqdm import tqdm
 
 import torch
+from torch.nn import functional as F
 from config import cfg as base_cfg
 from modeling.detector import build_detection_model
 from utils.checkpoint import ActionCheckpointer
 from dataset.transforms import video_transforms as T
 from dataset.transforms import object_transforms as OT
 from structures.memory_pool import MemoryPool
+from structures.buffer_pool import TensorBufferPool
 from dataset.collate_batch import batch_different_videos
 from video_detection_loader import VideoDetectionLoader
 from detector.apis import get_detector
@@ -23,8 +29,7 @@ def convert_boxlist(maskrcnn_boxlist):
     size = maskrcnn_boxlist.size
     mode = maskrcnn_boxlist.mode
     bbox = BoxList(box_tensor, size, mode)
-    for field in maskrcnn_boxlist.fields():
-        bbox.add_field(field, maskrcnn_boxlist.get_field(field))
+    bbox._copy_extra_fields(maskrcnn_boxlist)
     return bbox
 
 class AVAPredictor(object):
@@ -55,22 +60,49 @@ class AVAPredictor(object):
         self.timestamps = []
         _ = checkpointer.load(cfg.MODEL.WEIGHT)
 
-        self.transforms, self.person_transforms, self.object_transforms = self.build_transform()
+        self.temporal_crop, self.transforms, self.person_transforms, self.object_transforms = self.build_transform()
+        # Parts of the video transforms reused by gpu_transforms()
+        self.resize, _, _, self.slowfast_crop = self.transforms.transforms
+        # Frames of the temporally cropped clip kept by the slow or the fast pathway, only these are
+        # passed to gpu_transforms(). The positions of each pathway's frames among them are kept too.
+        slow_idx, fast_idx = self.slowfast_crop.get_indices(cfg.INPUT.FRAME_NUM)
+        self.slowfast_frames = np.union1d(slow_idx, fast_idx)
+        self.slow_positions = torch.from_numpy(np.searchsorted(self.slowfast_frames, slow_idx))
+        self.fast_positions = torch.from_numpy(np.searchsorted(self.slowfast_frames, fast_idx))
 
         self.device = device
         self.cpu_device = torch.device("cpu")
         self.exclude_class = exclude_class
+        self.amp_dtype = self.get_amp_dtype()
+        # Side stream for the frame uploads in gpu_transforms(). It is created lazily since this
+        # object is sent to the prediction worker process.
+        self.copy_stream = None
+        # Pinned host buffers for the frame uploads, reused across intervals.
+        self.buffer_pool = TensorBufferPool(pin_memory=True)
+        # Process-global settings and the compiled backbone are set up lazily as well, see
+        # _init_in_worker(). Compiled modules can not be sent to another process.
+        self.worker_initialized = False
+        # Normalization constants used by gpu_transforms(), allocated on the device on first use.
+        self.pixel_mean = None
+        self.pixel_std = None
+        # Number of frames converted to float at once when resizing in gpu_transforms().
+        self.resize_chunk_frames = 4
 
     def build_transform(self):
         cfg = self.cfg
 
+        # The temporal crop is kept apart, so that only the sampled frames need to be gathered
+        # from the frame buffer. The video transforms take the cropped frames.
+        temporal_crop = T.TemporalCrop(cfg.INPUT.FRAME_NUM, cfg.INPUT.FRAME_SAMPLE_RATE)
+
         transform = T.Compose(
             [
-                T.TemporalCrop(cfg.INPUT.FRAME_NUM, cfg.INPUT.FRAME_SAMPLE_RATE),
                 T.Resize(cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST),
                 T.ToTensor(),
+                # Frames captured by OpenCV are already in BGR order, so the channel
+                # swap is only needed when the model expects RGB input.
                 T.Normalize(
-                    mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD, to_bgr=cfg.INPUT.TO_BGR
+                    mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD, to_bgr=not cfg.INPUT.TO_BGR
                 ),
                 T.SlowFastCrop(cfg.INPUT.TAU, cfg.INPUT.ALPHA, False),
             ]
@@ -83,7 +115,137 @@ class AVAPredictor(object):
             OT.Resize(),
         ])
 
-        return transform, person_transforms, object_transform
+        return temporal_crop, transform, person_transforms, object_transform
+
+    def get_amp_dtype(self):
+        amp_dtype = self.cfg.TEST.AMP_DTYPE
+        if not amp_dtype:
+            return None
+        if amp_dtype not in ("float16", "bfloat16"):
+            raise ValueError(
+                "TEST.AMP_DTYPE should be 'float16', 'bfloat16' or empty, got '{}'".format(amp_dtype)
+            )
+        if self.device.type != "cuda":
+            return None
+        if amp_dtype == "bfloat16" and not torch.cuda.is_bf16_supported():
+            amp_dtype = "float16"
+        return getattr(torch, amp_dtype)
+
+    def autocast(self):
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast("cuda", dtype=self.amp_dtype)
+
+    def gpu_transforms(self, host_clip):
+        """Same as self.transforms, but resizing and normalization are done on the gpu
+
+        Args:
+            host_clip(Tensor): The [TxHxWxC](uint8) frames in BGR order, the frames of the
+                temporally cropped clip selected by self.slowfast_frames. It should be a pinned
+                buffer acquired from self.buffer_pool, it is released to the pool once uploaded.
+
+        Returns:
+            video_data(List(Tensor)): The slow and fast clips on the device.
+            target: Always None.
+            transform_randoms(dict): The random transforms
+        """
+        cfg = self.cfg
+        transform_randoms = {}
+        size = self.resize.get_size(host_clip.shape[1:3])
+        transform_randoms["Resize"] = size
+
+        if self.pixel_mean is None:
+            self.pixel_mean = torch.tensor(cfg.INPUT.PIXEL_MEAN, device=self.device).view(1, 3, 1, 1)
+            self.pixel_std = torch.tensor(cfg.INPUT.PIXEL_STD, device=self.device).view(1, 3, 1, 1)
+            self.slow_positions = self.slow_positions.to(self.device)
+            self.fast_positions = self.fast_positions.to(self.device)
+
+        # The frames are in a pinned buffer, so that the upload on the side stream is asynchronous
+        # and overlaps with the object detection and previous model work.
+        if self.copy_stream is None:
+            self.copy_stream = torch.cuda.Stream(device=self.device)
+        with torch.cuda.stream(self.copy_stream):
+            clip = host_clip.to(self.device, non_blocking=True)
+            copy_done = torch.cuda.Event()
+            copy_done.record(self.copy_stream)
+        # The pinned buffer can be reused once the copy is done.
+        self.buffer_pool.release(host_clip, copy_done)
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_event(copy_done)
+        # The clip was allocated on the copy stream but is consumed on the compute stream.
+        clip.record_stream(compute_stream)
+
+        # [TxHxWxC] -> [TxCxHxW]
+        clip = clip.permute(0, 3, 1, 2)
+        # Only a few full resolution frames are converted to float at a time, the resized clip is
+        # much smaller.
+        resized = torch.empty((clip.shape[0], 3, size[1], size[0]), dtype=torch.float32, device=self.device)
+        for start in range(0, clip.shape[0], self.resize_chunk_frames):
+            end = start + self.resize_chunk_frames
+            resized[start:end] = F.interpolate(
+                clip[start:end].float(), size=(size[1], size[0]), mode="bilinear", align_corners=False
+            )
+        clip = resized
+        # Frames captured by OpenCV are in BGR order.
+        if not cfg.INPUT.TO_BGR:
+            clip = clip[:, [2, 1, 0]]
+        clip = (clip - self.pixel_mean) / self.pixel_std
+        # [TxCxHxW] -> [CxTxHxW]
+        clip = clip.transpose(0, 1)
+
+        slow_clip = clip[:, self.slow_positions]
+        fast_clip = clip[:, self.fast_positions]
+        return [slow_clip, fast_clip], None, transform_randoms
+
+    def _init_in_worker(self):
+        # Set up what has to be done in the process that runs the model.
+        if self.device.type == "cuda":
+            # The clip size is fixed for a given video, let cudnn pick the fastest conv algorithms.
+            torch.backends.cudnn.benchmark = True
+        self.compile_model()
+        self.worker_initialized = True
+
+    def compile_model(self):
+        # torch.compile is only available since PyTorch 2.0 and needs Triton to generate GPU kernels.
+        # Only the backbone is compiled, since its input shapes are fixed for a given video while
+        # the number of boxes in the roi heads changes every interval.
+        if not self.cfg.TEST.COMPILE or self.device.type != "cuda" or not hasattr(torch, "compile"):
+            return
+        try:
+            import triton  # noqa: F401
+            import torch._inductor.config as inductor_config
+        except ImportError:
+            return
+        inductor_config.fx_graph_cache = True
+        self.model.backbone = torch.compile(self.model.backbone, mode="reduce-overhead", dynamic=False)
+
+    def warm_up(self, frame_size):
+        """Runs the backbone on dummy clips of the video size
+
+        The compiled backbone and the cudnn autotuner pick their kernels on the first calls.
+        Warming up before the frames arrive keeps this out of the first predictions.
+
+        Args:
+            frame_size(tuple): The size of video frames, (width, height)
+        """
+        if not self.worker_initialized:
+            self._init_in_worker()
+        if self.device.type != "cuda":
+            return
+
+        cfg = self.cfg
+        width, height = frame_size
+        clip_width, clip_height = self.resize.get_size((height, width))
+        clip = torch.zeros((3, cfg.INPUT.FRAME_NUM, clip_height, clip_width), device=self.device)
+        # Same shapes and layout as the clips built in update_feature().
+        video_data, _, _ = self.slowfast_crop(clip, None, {})
+        slow_clips = batch_different_videos([video_data[0]], cfg.DATALOADER.SIZE_DIVISIBILITY)
+        fast_clips = batch_different_videos([video_data[1]], cfg.DATALOADER.SIZE_DIVISIBILITY)
+
+        # With mode="reduce-overhead", the cuda graphs are recorded after a few calls.
+        with torch.no_grad(), self.autocast():
+            for _ in range(3):
+                self.model.backbone(slow_clips, fast_clips)
 
     def update_feature(self, video_data, boxes, objects, timestamp, transform_randoms):
         """Updates memory features pool and object features pool
@@ -99,24 +261,71 @@ class AVAPredictor(object):
             timestamp(int): The timestamp of center frame. In seconds
             transform_randoms(dict): The random transforms
         """
+        if not self.worker_initialized:
+            self._init_in_worker()
+
+        boxes = self.person_transforms(boxes, transform_randoms)
+        if objects is not None:
+            objects = self.object_transforms(objects, transform_randoms)
+
         slow_clips = batch_different_videos([video_data[0]], self.cfg.DATALOADER.SIZE_DIVISIBILITY)
         fast_clips = batch_different_videos([video_data[1]], self.cfg.DATALOADER.SIZE_DIVISIBILITY)
+        # Clips from gpu_transforms() are already on the device, moving them is a no-op then.
         slow_clips = slow_clips.to(self.device)
         fast_clips = fast_clips.to(self.device)
-        boxes = [self.person_transforms(boxes, transform_randoms).to(self.device)]
+        boxes = [boxes.to(self.device)]
         if objects is not None:
-            objects = self.object_transforms(objects, transform_randoms).to(self.device)
+            objects = objects.to(self.device)
         objects = [objects]
 
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             feature = self.model(slow_clips, fast_clips, boxes, objects, part_forward=0)
-            person_feature = [ft.to(self.cpu_device) for ft in feature[0]]
-            object_feature = [ft.to(self.cpu_device) for ft in feature[1]]
 
-        self.mem_pool["SingleVideo", timestamp] = person_feature[0]
-        self.object_pool["SingleVideo", timestamp] = object_feature[0]
+        # Features stay on the device until evict_feature() or offload_feature() releases them.
+        self.mem_pool["SingleVideo", timestamp] = feature[0][0]
+        self.object_pool["SingleVideo", timestamp] = feature[1][0]
         self.timestamps.append(timestamp)
 
+    def evict_feature(self, timestamp):
+        """Removes features that are too old to be used by later predictions
+
+        Predictions at timestamp or later only look back IA_STRUCTURE.LENGTH[0] memory
+        steps, so older features can be released. Only use it when timestamps are
+        predicted in increasing order.
+
+        Args:
+            timestamp(int): The latest timestamp that has been predicted. In seconds
+        """
+        for old_timestamp in self.pop_old_timestamps(timestamp):
+            if ("SingleVideo", old_timestamp) in self.mem_pool:
+                del self.mem_pool["SingleVideo", old_timestamp]
+                del self.object_pool["SingleVideo", old_timestamp]
+
+    def offload_feature(self, timestamp):
+        """Moves features out of the memory window of timestamp to cpu
+
+        Used when all the timestamps are predicted at the end, so that the features
+        kept on the device do not grow with the video length. The offloaded features
+        are moved back to the device when they are used.
+
+        Args:
+            timestamp(int): The latest timestamp that has been updated. In seconds
+        """
+        for old_timestamp in self.pop_old_timestamps(timestamp):
+            if ("SingleVideo", old_timestamp) in self.mem_pool:
+                self.mem_pool["SingleVideo", old_timestamp] = \
+                    self.mem_pool["SingleVideo", old_timestamp].to(self.cpu_device)
+                self.object_pool["SingleVideo", old_timestamp] = \
+                    self.object_pool["SingleVideo", old_timestamp].to(self.cpu_device)
+
+    def pop_old_timestamps(self, timestamp):
+        # Pops the timestamps of device features which are out of the memory window of timestamp.
+        mem_before = self.cfg.IA_STRUCTURE.LENGTH[0] * self.cfg.IA_STRUCTURE.MEMORY_RATE
+        old_timestamps = []
+        while self.timestamps and self.timestamps[0] < timestamp - mem_before:
+            old_timestamps.append(self.timestamps.pop(0))
+        return old_timestamps
+
     def compute_prediction(self, timestamp, vid_size):
         """Compute the actions score at a timestamp
 
@@ -134,23 +343,41 @@ class AVAPredictor(object):
         Returns:
             prediction(BoxList): The prediction results with boxes and scores.
         """
-        current_feat_p = self.mem_pool["SingleVideo", timestamp].to(self.device)
-        current_feat_o = self.object_pool["SingleVideo", timestamp].to(self.device)
+        return self.compute_prediction_batched([timestamp], [vid_size])[0]
+
+    def compute_prediction_batched(self, timestamps, vid_sizes, to_cpu=True):
+        """Compute the actions score at several timestamps in a single forward
+
+        Same as compute_prediction(), but the timestamps are batched together so
+        the action head only runs once.
+
+        Args:
+            timestamps(List(int)): The timestamps to be compute. In seconds
+            vid_sizes(List(tuple)): The size of video for each timestamp
+            to_cpu(bool): Whether to move the results to cpu. Keeping them on the device
+                avoids a synchronization, so that several calls can be queued on the gpu.
+
+        Returns:
+            predictions(List(BoxList)): The prediction results of each timestamp.
+        """
+        # Features may have been offloaded to cpu, moving them is a no-op otherwise.
+        current_feat_p = [self.mem_pool["SingleVideo", t].to(self.device) for t in timestamps]
+        current_feat_o = [self.object_pool["SingleVideo", t].to(self.device) for t in timestamps]
         extras = dict(
             person_pool=self.mem_pool,
-            movie_ids=["SingleVideo"],
-            timestamps=[timestamp],
-            current_feat_p=[current_feat_p],
-            current_feat_o=[current_feat_o],
+            movie_ids=["SingleVideo"] * len(timestamps),
+            timestamps=list(timestamps),
+            current_feat_p=current_feat_p,
+            current_feat_o=current_feat_o,
         )
 
-        with torch.no_grad():
+        with torch.no_grad(), self.autocast():
             output = self.model(None, None, None, None, extras=extras, part_forward=1)
-            output = [o.resize(vid_size).to(self.cpu_device) for o in output]
+            output = [o.resize(vid_size) for o, vid_size in zip(output, vid_sizes)]
+            if to_cpu:
+                output = [o.to(self.cpu_device) for o in output]
 
-        prediction = output[0]
-
-        return prediction
+        return output
 
 class AVAPredictorWorker(object):
     """Worker class for AVA prediction
@@ -168,7 +395,8 @@ class AVAPredictorWorker(object):
         self.realtime = cfg.realtime
 
         # Object Detector
-        object_cfg = copy.deepcopy(cfg)
+        # Only the detector field differs, a shallow copy is enough.
+        object_cfg = copy.copy(cfg)
         object_cfg.detector = "yolo"
         self.coco_det = get_detector(object_cfg)
 
@@ -186,15 +414,37 @@ class AVAPredictorWorker(object):
         self.input_queue = mp.Queue(maxsize=512)
         self.output_queue = mp.Queue()
 
+        # Number of input items the prediction worker prefetches from the input queue.
+        self.prefetch_numbers = 8
+        # Frames are passed to the prediction worker through shared memory slots, only the slot
+        # index goes through the input queue. Enough slots to fill the prefetch queue and as many
+        # waiting in the input queue, frames beyond that are pickled through the queue as before.
+        # Each slot holds a full frame of shared memory.
+        frame_slot_numbers = 2 * self.prefetch_numbers
+
         # Video Detection Loader
-        det_loader = VideoDetectionLoader(cfg, self.track_queue, self.input_queue)
+        det_loader = VideoDetectionLoader(cfg, self.track_queue, self.input_queue, frame_slot_numbers)
+        self.frame_slots = det_loader.frame_slots
+        self.free_slots = det_loader.free_slots
+        # Size of the video frames, used to warm up the model before the frames arrive.
+        self.frame_size = det_loader.videoinfo["frameSize"]
         det_loader.start()
 
         self.timestamps = []
-        self.frame_stack = []
-        self.extra_stack = []
         ava_cfg = self.ava_predictor.cfg
         self.frame_buffer_numbers = ava_cfg.INPUT.FRAME_NUM * ava_cfg.INPUT.FRAME_SAMPLE_RATE
+        # Incoming frames are written into a preallocated ring buffer. It is allocated lazily
+        # in the worker process since the frame size is only known on the first frame.
+        self.frame_ring = None
+        self.frame_arr = None
+        self.ring_idx = 0
+        self.extra_stack = deque(maxlen=self.frame_buffer_numbers)
+        # Positions, in temporal order, of the frames sampled by the temporal crop. Only these
+        # frames are gathered from the ring for each interval.
+        self.gather_indices = self.ava_predictor.temporal_crop.get_indices(self.frame_buffer_numbers)
+        if self.ava_predictor.device.type == "cuda":
+            # gpu_transforms() only takes the frames kept by the slow and fast pathways.
+            self.gather_indices = self.gather_indices[self.ava_predictor.slowfast_frames]
 
         # detection interval should be 1 second like AVA,
         # one reason is that our model with memory feature is trained with that.
@@ -205,6 +455,14 @@ class AVAPredictorWorker(object):
         self.interval = 1000//self.detect_rate
 
         self.vid_transforms = self.ava_predictor.transforms
+        # Object detection runs in a helper thread on its own cuda stream, overlapping with
+        # the video transforms. Both are created lazily in the prediction worker process.
+        self.det_executor = None
+        self.det_stream = None
+        # Original frame dimensions fed to the object detector, keyed on (h, w).
+        self.dim_cache = {}
+        # Number of timestamps computed in one forward when predicting after the whole video is loaded.
+        self.prediction_batch_size = 8
 
         self._stopped = mp.Value('b', False)
         self._task_done = mp.Value('b', False)
@@ -223,16 +481,25 @@ class AVAPredictorWorker(object):
         self.stop()
 
     def stop(self):
-        self.prediction_worker.join()
+        # Keep draining the queues while waiting for the worker. A process does not exit until
+        # its queue feeder threads have flushed, so joining first can hang on a full queue.
+        while self.prediction_worker.is_alive():
+            self.clear_queues()
+            self.prediction_worker.join(timeout=0.1)
         # clear queues
         self.clear_queues()
 
     def clear_queues(self):
         self.clear(self.input_queue)
+        self.clear(self.track_queue)
+        self.clear(self.output_queue)
 
-    def clear(self, queue):
-        while not queue.empty():
-            queue.get()
+    def clear(self, q):
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            return
 
     def read(self):
         '''
@@ -252,6 +519,40 @@ class AVAPredictorWorker(object):
         if not self.stopped:
             return self.track_queue.get()
 
+    def detect_objects(self, kframe):
+        kframe_data = self.coco_det.image_preprocess(kframe)
+        key = kframe.shape[:2]
+        im_dim_list_k = self.dim_cache.get(key)
+        if im_dim_list_k is None:
+            im_dim_list_k = torch.FloatTensor([[key[1], key[0], key[1], key[0]]])
+            self.dim_cache[key] = im_dim_list_k
+        if self.det_stream is None:
+            return self.coco_det.images_detection(kframe_data, im_dim_list_k)
+        # images_detection() returns the detections on cpu, which synchronizes the stream.
+        with torch.cuda.stream(self.det_stream):
+            return self.coco_det.images_detection(kframe_data, im_dim_list_k)
+
+    def prefetch_input(self, prefetch_queue):
+        # Move items from the input queue into a local queue in a background thread,
+        # so that receiving them overlaps with the prediction of the previous interval.
+        while not self.stopped:
+            try:
+                item = self.input_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            except FileNotFoundError:
+                continue
+            while not self.stopped:
+                try:
+                    prefetch_queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    def put_predictions(self, batch, predictions):
+        for prediction, (center_timestamp, _, ids) in zip(predictions, batch):
+            self.output_queue.put((prediction.to(self.ava_predictor.cpu_device), center_timestamp, ids))
+
     def compute_prediction(self):
         assert self.realtime == False, "AVAPredictorWorker.compute_prediction() can not be used in realtime mode"
         self._task_done.value = True
@@ -267,6 +568,12 @@ class AVAPredictorWorker(object):
 
         empty_flag = False
 
+        self.ava_predictor.warm_up(self.frame_size)
+
+        prefetch_queue = queue.Queue(maxsize=self.prefetch_numbers)
+        prefetch_thread = Thread(target=self.prefetch_input, args=(prefetch_queue,), daemon=True)
+        prefetch_thread.start()
+
         for i in count():
             if self.stopped:
                 print("Avaworker stopped")
@@ -275,54 +582,95 @@ class AVAPredictorWorker(object):
             # compute predictions
             if self.task_done == True and empty_flag:
                 print("The input queue is empty. Start working on prediction")
-                for center_timestamp, video_size, ids in tqdm(self.timestamps):
-                    predictions = self.ava_predictor.compute_prediction(center_timestamp//self.interval, video_size)
-                    self.output_queue.put((predictions, center_timestamp, ids))
+                # Launch the forward of each batch before bringing the results of the previous
+                # batch to cpu, so that the gpu does not wait for the synchronization.
+                pending = None
+                for start in tqdm(range(0, len(self.timestamps), self.prediction_batch_size)):
+                    batch = self.timestamps[start:start + self.prediction_batch_size]
+                    predictions = self.ava_predictor.compute_prediction_batched(
+                        [center_timestamp // self.interval for center_timestamp, _, _ in batch],
+                        [video_size for _, video_size, _ in batch],
+                        to_cpu=False,
+                    )
+                    if pending is not None:
+                        self.put_predictions(*pending)
+                    pending = (batch, predictions)
+                if pending is not None:
+                    self.put_predictions(*pending)
                 print("Prediction is done.")
                 self.output_queue.put("done")
                 self._task_done.value = False
 
             try:
-                extra, video_size = self.input_queue.get(timeout=1)
+                extra, video_size = prefetch_queue.get(timeout=1)
             except queue.Empty:
                 continue
-            except FileNotFoundError:
-                continue
 
             if extra == "Done":
                 empty_flag = True
                 continue
 
             frame, cur_millis, boxes, scores, ids = extra
-
-            self.frame_stack.append(frame)
+            slot = None
+            if isinstance(frame, int):
+                slot = frame
+                frame = self.frame_slots[slot].numpy()
+
+            if self.frame_ring is None or self.frame_ring.shape[1:] != frame.shape:
+                self.frame_ring = np.empty((self.frame_buffer_numbers,) + frame.shape, dtype=np.uint8)
+                if self.ava_predictor.device.type != "cuda":
+                    self.frame_arr = np.empty((len(self.gather_indices),) + frame.shape, dtype=np.uint8)
+                self.ring_idx = 0
+                # Keep the metadata deque aligned with the frames in the ring.
+                self.extra_stack.clear()
+            self.frame_ring[self.ring_idx % self.frame_buffer_numbers] = frame
+            self.ring_idx += 1
+            if slot is not None:
+                # The frame has been copied into the ring, so the slot can be reused.
+                self.free_slots.put(slot)
             self.extra_stack.append((cur_millis, boxes, scores, ids))
-            self.frame_stack = self.frame_stack[-self.frame_buffer_numbers:]
-            self.extra_stack = self.extra_stack[-self.frame_buffer_numbers:]
 
             # Predict action once per interval
-            if len(self.frame_stack) >= self.frame_buffer_numbers and cur_millis > self.last_milli + self.interval:
+            if self.ring_idx >= self.frame_buffer_numbers and cur_millis > self.last_milli + self.interval:
                 self.last_milli = cur_millis
-                frame_arr = np.stack(self.frame_stack)[..., ::-1]
                 center_index = self.frame_buffer_numbers // 2
                 center_timestamp, person_boxes, person_scores, person_ids = self.extra_stack[center_index]
 
                 if person_boxes is None or len(person_boxes) == 0:
                     continue
 
-                kframe = self.frame_stack[center_index]
+                # Once the ring is full, the oldest frame sits at the next write position.
+                # mode='wrap' maps the positions into the ring and lets numpy write to out directly.
+                # On cuda, the frames are gathered straight into the pinned buffer of the upload.
+                if self.ava_predictor.device.type == "cuda":
+                    host_clip = self.ava_predictor.buffer_pool.acquire(
+                        (len(self.gather_indices),) + self.frame_ring.shape[1:], torch.uint8)
+                    frame_arr = host_clip.numpy()
+                else:
+                    frame_arr = self.frame_arr
+                np.take(self.frame_ring, self.gather_indices + self.ring_idx, axis=0, out=frame_arr, mode='wrap')
+                # The ring is not written again before the object detection is done.
+                kframe = self.frame_ring[(center_index + self.ring_idx) % self.frame_buffer_numbers]
                 center_timestamp = int(center_timestamp)
 
-                video_data, _, transform_randoms = self.vid_transforms(frame_arr, None)
+                if self.det_executor is None:
+                    self.det_executor = ThreadPoolExecutor(max_workers=1)
+                    if self.ava_predictor.device.type == "cuda":
+                        self.det_stream = torch.cuda.Stream(device=self.ava_predictor.device)
+                det_future = self.det_executor.submit(self.detect_objects, kframe)
+
+                if self.ava_predictor.device.type == "cuda":
+                    video_data, _, transform_randoms = self.ava_predictor.gpu_transforms(host_clip)
+                else:
+                    video_data, _, transform_randoms = self.vid_transforms(frame_arr, None)
 
-                kframe_data = self.coco_det.image_preprocess(kframe)
-                im_dim_list_k = kframe.shape[1], kframe.shape[0]
-                im_dim_list_k = torch.FloatTensor(im_dim_list_k).repeat(1, 2)
-                dets = self.coco_det.images_detection(kframe_data, im_dim_list_k)
+                dets = det_future.result()
+                # The detections are already on cpu, the boxes are moved to the device
+                # together with the person boxes in update_feature().
                 if isinstance(dets, int) or dets.shape[0] == 0:
                     obj_boxes = torch.zeros((0,4))
                 else:
-                    obj_boxes = dets[:, 1:5].cpu()
+                    obj_boxes = dets[:, 1:5]
                 obj_boxes = BoxList(obj_boxes, video_size, "xyxy").clip_to_image()
 
                 person_box = BoxList(person_boxes, video_size, "xyxy").clip_to_image()
@@ -337,9 +685,13 @@ class AVAPredictorWorker(object):
                     predictions = self.ava_predictor.compute_prediction(center_timestamp // self.interval, video_size)
                     #print(len(predictions.get_field("scores")), person_ids)
                     self.output_queue.put((predictions, center_timestamp, person_ids[:, 0]))
+                    # Realtime predictions go forward in time, so old features will not be used again.
+                    self.ava_predictor.evict_feature(center_timestamp // self.interval)
                 else:
                     # if not realtime, timestamps will be saved and the predictions will be computed later.
                     self.timestamps.append((center_timestamp, video_size, person_ids[:, 0]))
+                    # Features are kept until the end of the video, so old ones are moved to cpu.
+                    self.ava_predictor.offload_feature(center_timestamp // self.interval)
 
     @property
     def stopped(self):
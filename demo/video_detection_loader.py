@@ -1,6 +1,6 @@
 from itertools import count
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
 
 import cv2
 import numpy as np
@@ -48,8 +48,14 @@ class Resize(object):
 class VideoDetectionLoader(object):
     '''
     This Class takes the video from the source (video file or camera) and tracks the person.
+
+    If frame_slot_numbers > 0, that many frames are allocated in shared memory (frame_slots), with
+    a queue of the free ones (free_slots). Frames are written into a free slot and only the slot
+    index is passed through the action queue, which avoids pickling the frame. The consumer puts
+    the slot index back to free_slots once it is done with the frame. When all the slots are in use,
+    or they can not be allocated, the frame itself is passed instead.
     '''
-    def __init__(self, cfg, track_queue, action_queue):
+    def __init__(self, cfg, track_queue, action_queue, frame_slot_numbers=0):
         self.detector = get_detector(cfg)
         self.input_path = cfg.input_path
 
@@ -67,6 +73,21 @@ class VideoDetectionLoader(object):
         self._stopped = mp.Value('b', False)
         self.track_queue = track_queue
         self.action_queue = action_queue
+        self.frame_slots = None
+        self.free_slots = None
+        if frame_slot_numbers > 0:
+            frame_width, frame_height = self.frameSize
+            try:
+                self.frame_slots = torch.empty((frame_slot_numbers, frame_height, frame_width, 3),
+                                               dtype=torch.uint8).share_memory_()
+            except (RuntimeError, OSError) as e:
+                # e.g. /dev/shm is too small, frames are pickled through the queue instead.
+                print("Cannot allocate shared frame slots, fall back to pickled frames: {}".format(e))
+                frame_slot_numbers = 0
+        if frame_slot_numbers > 0:
+            self.free_slots = mp.Queue()
+            for slot in range(frame_slot_numbers):
+                self.free_slots.put(slot)
 
     def start_worker(self, target):
         p = mp.Process(target=target, args=())
@@ -93,8 +114,11 @@ class VideoDetectionLoader(object):
         self.clear(self.action_queue)
 
     def clear(self, queue):
-        while not queue.empty():
-            queue.get()
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            return
 
     def wait_and_put(self, queue, item):
         if not self.stopped:
@@ -104,6 +128,14 @@ class VideoDetectionLoader(object):
         if not self.stopped:
             return queue.get()
     
+    def acquire_slot(self):
+        # Never wait for the consumer, otherwise tracking would be tied to the speed of action
+        # prediction. Return None if all the slots are in use.
+        try:
+            return self.free_slots.get_nowait()
+        except Empty:
+            return None
+
     def wait_till_empty(self, queue):
         from time import sleep
         from tqdm import tqdm
@@ -208,6 +240,12 @@ class VideoDetectionLoader(object):
 
             # all parameters to be used in ava
             frame, cur_millis = extra
+            # If no slot is free or the frame size does not match, the frame itself is sent.
+            if self.frame_slots is not None and tuple(self.frame_slots.shape[1:]) == frame.shape:
+                slot = self.acquire_slot()
+                if slot is not None:
+                    self.frame_slots[slot].numpy()[...] = frame
+                    frame = slot
             input = (frame, cur_millis, boxes, scores, ids)
 
             # Passing these information to AVAPredictorWorker
@@ -35,6 +35,8 @@ class Pooler3d(nn.Module):
         return rois
 
     def forward(self, x, boxes):
+        # The roi kernels only support float and double, features may be half under autocast.
+        x = x.float()
         rois = self.convert_to_roi_format(boxes, x.dtype, x.device)
         return self.pooler(x, rois)
 
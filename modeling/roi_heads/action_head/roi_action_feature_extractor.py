@@ -6,6 +6,7 @@ from modeling import registry
 from modeling.poolers import make_3d_pooler
 from modeling.roi_heads.action_head.IA_structure import make_ia_structure
 from modeling.utils import cat, pad_sequence, prepare_pooled_feature
+from structures.bounding_box import BoxList
 from utils.IA_helper import has_object
 
 
@@ -41,6 +42,7 @@ class MLPFeatureExtractor(nn.Module):
             nn.init.constant_(l.bias, 0)
 
         self.dim_out = representation_size
+        self.fuse_roi = config.TEST.FUSE_ROI
 
     def roi_pooling(self, slow_features, fast_features, proposals):
         if slow_features is not None:
@@ -62,6 +64,18 @@ class MLPFeatureExtractor(nn.Module):
             x = torch.cat([slow_x, fast_x], dim=1)
         return x
 
+    def fused_roi_pooling(self, slow_features, fast_features, proposals, objects):
+        # Concatenate the person and object boxes of each clip, so that both are pooled
+        # with one roi pooling call per pathway, and split the pooled features afterwards.
+        object_boxes = [o.bbox if o is not None else p.bbox.new_zeros((0, 4)) for p, o in zip(proposals, objects)]
+        merged_boxes = [BoxList(torch.cat([p.bbox, o]), p.size, p.mode) for p, o in zip(proposals, object_boxes)]
+        x = self.roi_pooling(slow_features, fast_features, merged_boxes)
+        split_sizes = []
+        for p, o in zip(proposals, object_boxes):
+            split_sizes += [len(p), len(o)]
+        x = x.split(split_sizes, dim=0)
+        return cat(x[0::2]), cat(x[1::2])
+
     def max_pooling_zero_safe(self, x):
         if x.size(0) == 0:
             _, c, t, h, w = x.size()
@@ -76,6 +90,10 @@ class MLPFeatureExtractor(nn.Module):
         if part_forward == 1:
             person_pooled = cat([box.get_field("pooled_feature") for box in proposals])
             object_pooled = cat([box.get_field("pooled_feature") for box in objects])
+        elif self.fuse_roi and has_object(self.config.IA_STRUCTURE):
+            x, object_pooled = self.fused_roi_pooling(slow_features, fast_features, proposals, objects)
+            person_pooled = self.max_pooler(x)
+            object_pooled = self.max_pooling_zero_safe(object_pooled)
         else:
             x = self.roi_pooling(slow_features, fast_features, proposals)
 
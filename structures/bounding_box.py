@@ -52,8 +52,7 @@ class BoxList(object):
         return list(self.extra_fields.keys())
 
     def _copy_extra_fields(self, bbox):
-        for k, v in bbox.extra_fields.items():
-            self.extra_fields[k] = v
+        self.extra_fields.update(bbox.extra_fields)
 
     def convert(self, mode):
         if mode not in ("xyxy", "xywh"):
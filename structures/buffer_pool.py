@@ -0,0 +1,27 @@
+from collections import defaultdict
+
+import torch
+
+
+class TensorBufferPool(object):
+    """
+    This class keeps released tensors and hands them out again for the same shape and dtype,
+    so that fixed size buffers are not allocated again and again.
+    A tensor can be released together with a cuda event, e.g. recorded after an asynchronous
+    copy from it. It will not be reused before the event completes.
+    """
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
+        self.cache = defaultdict(list)
+
+    def acquire(self, shape, dtype=torch.float32):
+        buffers = self.cache[(tuple(shape), dtype)]
+        if buffers:
+            tensor, event = buffers.pop()
+            if event is not None:
+                event.synchronize()
+            return tensor
+        return torch.empty(tuple(shape), dtype=dtype, pin_memory=self.pin_memory)
+
+    def release(self, tensor, event=None):
+        self.cache[(tuple(tensor.shape), tensor.dtype)].append((tensor, event))
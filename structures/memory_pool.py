@@ -23,6 +23,12 @@ class MemoryPool(object):
         else:
             self.cache[key] = value
 
+    def __delitem__(self, key):
+        if isinstance(key, tuple) and len(key)==2:
+            del self.cache[key[0]][key[1]]
+        else:
+            del self.cache[key]
+
     def __contains__(self, item):
         if isinstance(item, tuple) and len(item)==2:
             return (item[1] in self.cache[item[0]])